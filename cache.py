@@ -0,0 +1,82 @@
+"""
+Response Cache Helpers
+
+Optional Redis cache for rendered API responses. Set REDIS_URL to enable it;
+without it (or when Redis is unreachable) every helper is a no-op.
+"""
+
+import os
+from typing import AsyncIterator, Optional, Tuple
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Responses larger than this are not worth holding in Redis
+MAX_CACHED_BYTES = 1024 * 1024
+DEFAULT_EXPIRE = 300
+
+_redis = None
+
+redis_url = os.getenv("REDIS_URL")
+
+if redis_url:
+    import redis.asyncio as redis
+
+    _redis = redis.Redis.from_url(redis_url)
+
+
+async def _generation(namespace: str) -> int:
+    return int(await _redis.get(f"{namespace}:gen") or 0)
+
+
+async def get_cached(namespace: str, key: str) -> Tuple[Optional[bytes], Optional[int]]:
+    """Return (body, generation) for key; body is None on a miss.
+
+    Pass the generation on to set_cached so a miss is filled under the generation it was
+    looked up in: if a write bumps the namespace meanwhile, the stale body is never served.
+    """
+    if _redis is None:
+        return None, None
+    try:
+        generation = await _generation(namespace)
+        return await _redis.get(f"{namespace}:{generation}:{key}"), generation
+    except redis.RedisError:
+        return None, None
+
+
+async def set_cached(
+    namespace: str, key: str, generation: Optional[int], body: bytes, expire: int = DEFAULT_EXPIRE
+):
+    """Cache a rendered body under key in the given generation, skipping oversized payloads"""
+    if _redis is None or generation is None or len(body) > MAX_CACHED_BYTES:
+        return
+    try:
+        await _redis.set(f"{namespace}:{generation}:{key}", body, ex=expire)
+    except redis.RedisError:
+        pass
+
+
+async def clear_namespace(namespace: str):
+    """Invalidate every entry in namespace by bumping its generation"""
+    if _redis is None:
+        return
+    try:
+        await _redis.incr(f"{namespace}:gen")
+    except redis.RedisError:
+        pass
+
+
+async def cache_stream(
+    namespace: str, key: str, generation: Optional[int], chunks: AsyncIterator[bytes]
+) -> AsyncIterator[bytes]:
+    """Pass chunks through, caching the assembled body in generation once the stream completes"""
+    body: Optional[bytearray] = bytearray() if generation is not None else None
+    async for chunk in chunks:
+        if body is not None:
+            body += chunk
+            if len(body) > MAX_CACHED_BYTES:
+                body = None
+        yield chunk
+    if body is not None:
+        await set_cached(namespace, key, generation, bytes(body))
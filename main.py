@@ -1,32 +1,89 @@
+import asyncio
+import logging
 import os
-from typing import List, Optional, Any
-from fastapi import FastAPI, HTTPException, Header, Query
+import re
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, List, Optional, Any
+from fastapi import Depends, FastAPI, HTTPException, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+import msgspec
+import orjson
 
 from database import db, create_document, get_documents
+from cache import get_cached, set_cached, clear_namespace, cache_stream
 from schemas import Product as ProductSchema, Order as OrderSchema
 
+logger = logging.getLogger(__name__)
 
-class ObjectIdStr(str):
-    @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
+# Bind the collections once rather than re-indexing db on every request
+PRODUCTS = db["product"] if db is not None else None
+ORDERS = db["order"] if db is not None else None
 
-    @classmethod
-    def validate(cls, v):
-        if isinstance(v, ObjectId):
-            return str(v)
-        try:
-            ObjectId(str(v))
-            return str(v)
-        except Exception:
-            raise ValueError("Invalid ObjectId")
+
+def parse_product_id(product_id: str) -> ObjectId:
+    try:
+        return ObjectId(product_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid product id")
+
+
+# Ids on outbound documents were generated by Mongo, so they are plain strings
+ObjectIdOut = str
+
+
+def _orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+
+class MongoJSONResponse(ORJSONResponse):
+    """ORJSONResponse that also knows how to encode ObjectId values."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
 
 
-class ProductOut(BaseModel):
-    id: ObjectIdStr
+def strip_empty(doc: dict) -> dict:
+    """Drop None and empty list/dict values; clients treat a missing key as the default."""
+    return {k: v for k, v in doc.items() if v is not None and v != [] and v != {}}
+
+
+def _encode_document(d: dict) -> bytes:
+    d["id"] = str(d.pop("_id"))
+    d.pop("score", None)
+    return orjson.dumps(strip_empty(d), default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+async def stream_documents(cursor) -> AsyncIterator[bytes]:
+    """Encode a cursor's documents as a JSON array, one document at a time.
+
+    Await this before building the response: it runs the query and fetches the first batch
+    up front, so Mongo errors surface as a normal 500 instead of a truncated 200 stream.
+    """
+    first = await anext(cursor, None)
+
+    async def chunks() -> AsyncIterator[bytes]:
+        if first is None:
+            yield b"[]"
+            return
+        yield b"[" + _encode_document(first)
+        async for d in cursor:
+            yield b"," + _encode_document(d)
+        yield b"]"
+
+    return chunks()
+
+
+# Response body of update_product, encoded by msgspec without a Pydantic validation/serialization pass.
+# Pydantic stays on the request side (schemas.py), where validation is wanted.
+# The only defaults are None/empty, so omit_defaults trims exactly what strip_empty does elsewhere.
+class ProductOut(msgspec.Struct, kw_only=True, omit_defaults=True):
+    id: ObjectIdOut
     title: str
     description: Optional[str] = None
     price: float
@@ -35,21 +92,120 @@ class ProductOut(BaseModel):
     images: List[str] = []
     stock: int
     specifications: dict = {}
-    featured: bool = False
+    featured: bool
+
+
+# get_product returns the same fields as update_product, leaving out timestamps and other stored keys
+PRODUCT_PROJECTION: dict[str, Any] = {field: 1 for field in ProductOut.__struct_fields__ if field != "id"}
+
+
+# Fields returned by list_products; images are trimmed to the first (thumbnail) one
+LIST_PROJECTION: dict[str, Any] = {
+    "title": 1,
+    "price": 1,
+    "category": 1,
+    "brand": 1,
+    "stock": 1,
+    "featured": 1,
+    "images": {"$slice": 1},
+}
+# Heavier fields list_products clients can opt into with ?fields=
+OPTIONAL_LIST_FIELDS = {"description", "images", "specifications"}
+# Homepage strip (?featured=true alone) only shows a thumbnail, title and price
+FEATURED_PROJECTION: dict[str, Any] = {
+    "title": 1,
+    "price": 1,
+    "featured": 1,
+    "images": {"$slice": 1},
+}
+
+
+def _search_filter(q: str) -> dict[str, Any]:
+    if len(q) > 1 and _has_text_index:
+        # Full-text search backed by the "product_text" index
+        return {"$text": {"$search": q}}
+    # Single characters are stop-worded away by $text, and $text fails outright without a text
+    # index (e.g. Mongo was unreachable at startup); fall back to a prefix match.
+    # Escape the input so it is matched literally rather than run as a user-supplied pattern.
+    pattern = f"^{re.escape(q)}"
+    return {
+        "$or": [
+            {"title": {"$regex": pattern, "$options": "i"}},
+            {"description": {"$regex": pattern, "$options": "i"}},
+        ]
+    }
+
+
+# list_products filter per (q, category, featured) presence mask, with the index to hint.
+# Search shapes are left to the planner: $text queries cannot take a hint.
+_QUERY_BUILDERS: dict[
+    int, Callable[[Optional[str], Optional[str], Optional[bool]], tuple[dict[str, Any], Optional[str]]]
+] = {
+    0b000: lambda q, c, f: ({}, None),
+    0b001: lambda q, c, f: ({"featured": f}, "featured_1"),
+    0b010: lambda q, c, f: ({"category": c}, "category_1_featured_1"),
+    0b011: lambda q, c, f: ({"category": c, "featured": f}, "category_1_featured_1"),
+    0b100: lambda q, c, f: (_search_filter(q), None),
+    0b101: lambda q, c, f: ({**_search_filter(q), "featured": f}, None),
+    0b110: lambda q, c, f: ({**_search_filter(q), "category": c}, None),
+    0b111: lambda q, c, f: ({**_search_filter(q), "category": c, "featured": f}, None),
+}
 
-    class Config:
-        from_attributes = True
 
+# Product index names confirmed to exist at startup. Hints name an index and fail the query when
+# it is missing, so list_products only hints indexes listed here.
+_product_indexes: set[str] = set()
+# Whether the product collection has a text index (under any name) for $text searches
+_has_text_index = False
 
-class OrderOut(BaseModel):
-    id: ObjectIdStr
-    total: float
-    status: str
-    items: list
-    customer: dict
+
+async def _create_index(collection, keys, **kwargs):
+    # One index failing (e.g. an existing index with other options) must not skip the rest
+    try:
+        await collection.create_index(keys, **kwargs)
+    except OperationFailure as e:
+        logger.warning("Could not create index %s on %s: %s", kwargs.get("name", keys), collection.name, e)
 
 
-app = FastAPI(title="Arihant Automobiles API", version="1.0.0")
+async def ensure_indexes():
+    global _has_text_index
+    if PRODUCTS is None:
+        return
+    # Index problems (Mongo unreachable, a conflicting existing index) must not keep the API from
+    # booting; /test still reports the database status
+    try:
+        await _create_index(
+            PRODUCTS,
+            [("title", "text"), ("description", "text")],
+            weights={"title": 10, "description": 1},
+            name="product_text",
+        )
+        # Filter shapes used by list_products; a collection may only have one text index
+        await _create_index(PRODUCTS, [("category", 1), ("featured", 1)])
+        await _create_index(PRODUCTS, [("featured", 1)])
+        # Partial index holding only featured products; small enough to stay in RAM for the homepage
+        await _create_index(
+            PRODUCTS,
+            [("featured", 1), ("price", 1)],
+            partialFilterExpression={"featured": True},
+            name="featured_price_partial",
+        )
+        # list_orders sorts newest first
+        await _create_index(ORDERS, [("created_at", -1)])
+        info = await PRODUCTS.index_information()
+        _product_indexes.update(info)
+        _has_text_index = any(kind == "text" for index in info.values() for _, kind in index["key"])
+    except PyMongoError as e:
+        logger.warning("Could not ensure indexes: %s", e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ensure_indexes()
+    yield
+
+
+app = FastAPI(title="Arihant Automobiles API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -60,23 +216,25 @@ app.add_middleware(
 )
 
 
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+
+
 def require_admin(x_admin_key: Optional[str] = Header(default=None)):
-    admin_key = os.getenv("ADMIN_API_KEY")
-    if not admin_key:
+    if not ADMIN_API_KEY:
         # If not set, allow for development convenience
         return True
-    if x_admin_key != admin_key:
+    if x_admin_key != ADMIN_API_KEY:
         raise HTTPException(status_code=401, detail="Invalid admin key")
     return True
 
 
 @app.get("/")
-def root():
+async def root():
     return {"name": "Arihant Automobiles API", "status": "ok"}
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -89,7 +247,7 @@ def test_database():
             response["database"] = "✅ Connected"
             response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
             response["database_name"] = db.name
-            response["collections"] = db.list_collection_names()
+            response["collections"] = await db.list_collection_names()
         else:
             response["database"] = "❌ Not Available"
     except Exception as e:
@@ -100,113 +258,167 @@ def test_database():
 # -----------------
 # Products Endpoints
 # -----------------
-@app.get("/api/products", response_model=List[ProductOut])
-def list_products(
+@app.get("/api/products")
+async def list_products(
+    request: Request,
     q: Optional[str] = Query(default=None, description="Search query"),
     category: Optional[str] = None,
     featured: Optional[bool] = None,
+    fields: Optional[str] = Query(
+        default=None, description="Comma-separated extra fields: description, images, specifications"
+    ),
     limit: int = 100,
 ):
-    if db is None:
+    if PRODUCTS is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    query: dict[str, Any] = {}
-    if q:
-        query["$or"] = [
-            {"title": {"$regex": q, "$options": "i"}},
-            {"description": {"$regex": q, "$options": "i"}},
-        ]
-    if category:
-        query["category"] = category
-    if featured is not None:
-        query["featured"] = featured
-
-    docs = list(db["product"].find(query).limit(limit))
-    for d in docs:
-        d["id"] = str(d.pop("_id"))
-    return docs
+    cache_key = f"list:{request.url.query}"
+    cached, generation = await get_cached("products", cache_key)
+    if cached is not None:
+        return Response(cached, media_type="application/json")
+
+    projection = dict(LIST_PROJECTION)
+    if fields:
+        for field in fields.split(","):
+            field = field.strip()
+            if field in OPTIONAL_LIST_FIELDS:
+                projection[field] = 1
+
+    mask = (0b100 if q else 0) | (0b010 if category else 0) | (0b001 if featured is not None else 0)
+    query, hint = _QUERY_BUILDERS[mask](q, category, featured)
+    if mask == 0b001 and featured and not fields:
+        # Homepage strip: walk the partial featured index and fetch just what the strip shows
+        projection = dict(FEATURED_PROJECTION)
+        hint = "featured_price_partial"
+
+    if "$text" in query:
+        # Best matches first
+        projection["score"] = {"$meta": "textScore"}
+        cursor = PRODUCTS.find(query, projection).sort([("score", {"$meta": "textScore"})])
+    else:
+        cursor = PRODUCTS.find(query, projection)
+    if hint in _product_indexes:
+        cursor = cursor.hint(hint)
+
+    cursor = cursor.batch_size(100).limit(limit)
+    return StreamingResponse(
+        cache_stream("products", cache_key, generation, await stream_documents(cursor)),
+        media_type="application/json",
+    )
 
 
-@app.post("/api/products", response_model=ObjectIdStr)
-def create_product(payload: ProductSchema, _=require_admin()):
-    new_id = create_document("product", payload)
+@app.post("/api/products", response_model=ObjectIdOut)
+async def create_product(payload: ProductSchema, _: bool = Depends(require_admin)):
+    new_id = await create_document("product", payload)
+    await clear_namespace("products")
     return new_id
 
 
-@app.get("/api/products/{product_id}", response_model=ProductOut)
-def get_product(product_id: str):
-    if db is None:
+@app.get("/api/products/{product_id}", response_class=MongoJSONResponse)
+async def get_product(product_id: str):
+    if PRODUCTS is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    try:
-        doc = db["product"].find_one({"_id": ObjectId(product_id)})
-        if not doc:
-            raise HTTPException(status_code=404, detail="Product not found")
-        doc["id"] = str(doc.pop("_id"))
-        return doc
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid product id")
+    cache_key = f"id:{product_id}"
+    cached, generation = await get_cached("products", cache_key)
+    if cached is not None:
+        return Response(cached, media_type="application/json")
+    doc = await PRODUCTS.find_one({"_id": parse_product_id(product_id)}, PRODUCT_PROJECTION)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Product not found")
+    doc["id"] = str(doc.pop("_id"))
+    response = MongoJSONResponse(strip_empty(doc))
+    await set_cached("products", cache_key, generation, response.body)
+    return response
 
 
-@app.put("/api/products/{product_id}", response_model=ProductOut)
-def update_product(product_id: str, payload: ProductSchema, _=require_admin()):
-    if db is None:
+@app.put("/api/products/{product_id}")
+async def update_product(product_id: str, payload: ProductSchema, _: bool = Depends(require_admin)):
+    if PRODUCTS is None:
         raise HTTPException(status_code=500, detail="Database not configured")
     data = payload.model_dump()
-    data["updated_at"] = __import__("datetime").datetime.utcnow()
-    res = db["product"].find_one_and_update(
-        {"_id": ObjectId(product_id)},
+    data["updated_at"] = datetime.now(timezone.utc)
+    res = await PRODUCTS.find_one_and_update(
+        {"_id": parse_product_id(product_id)},
         {"$set": data},
         return_document=True,
     )
     if not res:
         raise HTTPException(status_code=404, detail="Product not found")
+    await clear_namespace("products")
     res["id"] = str(res.pop("_id"))
-    return res
+    # The document was just validated on the way in; build the response without re-validating it
+    product = ProductOut(**{k: v for k, v in res.items() if k in ProductOut.__struct_fields__})
+    return Response(msgspec.json.encode(product), media_type="application/json")
 
 
 @app.delete("/api/products/{product_id}")
-def delete_product(product_id: str, _=require_admin()):
-    if db is None:
+async def delete_product(product_id: str, _: bool = Depends(require_admin)):
+    if PRODUCTS is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    res = db["product"].delete_one({"_id": ObjectId(product_id)})
+    res = await PRODUCTS.delete_one({"_id": parse_product_id(product_id)})
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await clear_namespace("products")
     return {"deleted": True}
 
 
 # --------------
 # Orders Endpoint
 # --------------
-@app.post("/api/orders", response_model=ObjectIdStr)
-def create_order(order: OrderSchema):
+@app.post("/api/orders", response_model=ObjectIdOut)
+async def create_order(order: OrderSchema):
     # Optionally validate items exist
-    if db is None:
+    if PRODUCTS is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    # Reserve stock: ensure enough stock for each item
-    for item in order.items:
-        try:
-            prod = db["product"].find_one({"_id": ObjectId(item.product_id)})
-            if not prod:
-                raise HTTPException(status_code=400, detail=f"Product not found: {item.product_id}")
-            if prod.get("stock", 0) < item.quantity:
-                raise HTTPException(status_code=400, detail=f"Insufficient stock for {prod['title']}")
-        except HTTPException:
-            raise
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid product id in order")
-
-    # Deduct stock atomically per item
-    for item in order.items:
-        db["product"].update_one({"_id": ObjectId(item.product_id)}, {"$inc": {"stock": -item.quantity}})
-
-    order_id = create_document("order", order)
+    # Parse each distinct product id once; carts often repeat a product across lines
+    try:
+        oid_by_id = {pid: ObjectId(pid) for pid in {item.product_id for item in order.items}}
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid product id in order")
+    oids = [oid_by_id[item.product_id] for item in order.items]
+
+    # Reserve stock: ensure enough stock for each item, fetching all products in one query
+    prods = {
+        p["_id"]: p
+        async for p in PRODUCTS.find({"_id": {"$in": list(oid_by_id.values())}}, {"stock": 1, "title": 1})
+    }
+    for oid, item in zip(oids, order.items):
+        prod = prods.get(oid)
+        if not prod:
+            raise HTTPException(status_code=400, detail=f"Product not found: {item.product_id}")
+        if prod.get("stock", 0) < item.quantity:
+            raise HTTPException(status_code=400, detail=f"Insufficient stock for {prod['title']}")
+
+    # Deduct stock for all items concurrently; the filter makes each $inc conditional on the stock still being there
+    results = await asyncio.gather(
+        *(
+            PRODUCTS.update_one(
+                {"_id": oid, "stock": {"$gte": item.quantity}},
+                {"$inc": {"stock": -item.quantity}},
+            )
+            for oid, item in zip(oids, order.items)
+        )
+    )
+    failed = [oid for oid, res in zip(oids, results) if res.matched_count == 0]
+    if failed:
+        # Another order drained some product since the check above; give back what we took
+        await asyncio.gather(
+            *(
+                PRODUCTS.update_one({"_id": oid}, {"$inc": {"stock": item.quantity}})
+                for oid, item, res in zip(oids, order.items, results)
+                if res.matched_count
+            )
+        )
+        raise HTTPException(status_code=409, detail=f"Insufficient stock for {prods[failed[0]]['title']}")
+    # Stock levels are part of the cached product payloads
+    await clear_namespace("products")
+
+    order_id = await create_document("order", order)
     return order_id
 
 
-@app.get("/api/orders", response_model=List[OrderOut])
-def list_orders(_=require_admin(), limit: int = 100):
-    if db is None:
+@app.get("/api/orders")
+async def list_orders(_: bool = Depends(require_admin), limit: int = 100):
+    if ORDERS is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    docs = list(db["order"].find({}).sort("created_at", -1).limit(limit))
-    for d in docs:
-        d["id"] = str(d.pop("_id"))
-    return docs
+    cursor = ORDERS.find({}).sort("created_at", -1).batch_size(100).limit(limit)
+    return StreamingResponse(await stream_documents(cursor), media_type="application/json")